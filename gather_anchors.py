@@ -1,6 +1,6 @@
 import torch
 from yolov3tiny import data
-from tqdm import trange
+from tqdm import tqdm
 import numpy as np
 import mlpack
 
@@ -10,8 +10,7 @@ def get_coco_anchor_boxes(images_dir:str, annotations_dir:str, img_size:int, num
     wh = []
     dataloader = data.build_coco_dataloader(images_dir, annotations_dir, img_size, num_classes, max_num_boxes, 1, False, data.prepare_for_inference)
 
-    for _ in trange(len(dataloader)):
-        batch = next(iter(dataloader))
+    for batch in tqdm(dataloader):
         boxw = (batch[1][0, :, 2] - batch[1][0, :, 0]).long().tolist()[:batch[2][0]]
         boxh = (batch[1][0, :, 3] - batch[1][0, :, 1]).long().tolist()[:batch[2][0]]
         wh.extend(list(zip(boxw, boxh)))
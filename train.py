@@ -26,6 +26,7 @@ def display_image_tensor(image: torch.Tensor, labels:torch.Tensor, size:int, num
 
 if __name__ == "__main__":
     torch.manual_seed(12345)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
 
     # dataset
     val_images_dir = "./data/val2017/"
@@ -46,17 +47,22 @@ if __name__ == "__main__":
 
     # dataloader
     dataloader = data.build_coco_dataloader(val_images_dir, val_annotations_dir, img_size, num_classes, max_num_boxes, batch_size, True, data.prepare_for_training)
+    if device == "cuda":
+        dataloader = data.CUDAPrefetcher(dataloader, device, keep_on_host=(2,))
+
+    augment = data.BatchAugmentation().to(device)
 
     images, labels, labels_size = next(iter(dataloader))
+    images, labels = augment(images, labels, labels_size)
     print("Input data shape: ", images.shape)
     print("Target labels shape: ", labels.shape)
     print("Number of labels: ", labels_size)
 
     # model
-    yolo_v3_tiny = model.YOLOv3tiny(num_classes, anchors, img_size)
+    yolo_v3_tiny = model.YOLOv3tiny(num_classes, anchors, img_size).to(device)
 
     # loss + optimizer
-    lossfn = YOLOLoss(coord_weight, object_weight, no_object_weight, class_weight, max_num_boxes)
+    lossfn = YOLOLoss(coord_weight, object_weight, no_object_weight, class_weight, compile_giou=device == "cuda")
 
     # training loop
     output = yolo_v3_tiny(images)
@@ -64,6 +70,6 @@ if __name__ == "__main__":
     loss = lossfn(output, labels, labels_size)
     print("Loss: ", loss)
 
-    display_image_tensor(images[0],  labels[0], labels_size[0].item(), num_classes)
+    display_image_tensor(images[0].cpu(),  labels[0].cpu(), labels_size[0].item(), num_classes)
 
 
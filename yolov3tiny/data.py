@@ -1,20 +1,21 @@
+import os
+import numba
+import numpy as np
 import torch
 import torchvision
+import kornia
 from torchvision.datasets import CocoDetection
+from torchvision.transforms import v2
 
 
 from PIL import Image
 
 def cxcywh_to_xyxy(bbox: torch.Tensor):
-    bbox[..., 0] -= bbox[..., 2] / 2
-    bbox[..., 1] -= bbox[..., 3] / 2
-    bbox[..., 2] = bbox[..., 0] + bbox[..., 2]
-    bbox[..., 3] = bbox[..., 1] + bbox[..., 3]
-    return bbox
+    xy = bbox[..., 0:2] - bbox[..., 2:4] / 2
+    return torch.cat([xy, xy + bbox[..., 2:4]], dim=-1)
 
 def xywh_to_xyxy(bbox: torch.Tensor):
-    bbox[..., 2] = bbox[..., 0] + bbox[..., 2]
-    bbox[..., 3] = bbox[..., 1] + bbox[..., 3]
+    bbox[..., 2:4] += bbox[..., 0:2]
     return bbox
 
 def get_names(names_from_paper:str, actual_names:str):
@@ -45,8 +46,8 @@ class ToSquare:
     def __init__(self, fill=127):
         self.fill = fill
 
-    def __call__(self, image: torch.Tensor, label: torch.Tensor|None = None):
-        h, w = image.shape[-2:]
+    def __call__(self, image: Image.Image|torch.Tensor, label: torch.Tensor|None = None):
+        h, w = v2.functional.get_size(image) # type: ignore
         diff = abs(w - h)
         pad1 = diff // 2
         pad2 = diff - pad1
@@ -60,7 +61,7 @@ class ToSquare:
             if label is not None:
                 label[..., 0] += pad1
                 label[..., 2] += pad1
-        padded_image = torchvision.transforms.functional.pad(image, padding, self.fill) # type: ignore
+        padded_image = v2.functional.pad(image, list(padding), self.fill) # type: ignore
         return padded_image, label
 
 class Resize:
@@ -68,8 +69,8 @@ class Resize:
         self.width = width
         self.height = height 
 
-    def __call__(self, image: torch.Tensor, label: torch.Tensor|None = None):
-        h, w = image.shape[-2:]
+    def __call__(self, image: Image.Image|torch.Tensor, label: torch.Tensor|None = None):
+        h, w = v2.functional.get_size(image) # type: ignore
         scale_w = self.width / w
         scale_h = self.height / h
         if label is not None:
@@ -77,139 +78,208 @@ class Resize:
             label[..., 1] *= scale_h
             label[..., 2] *= scale_w
             label[..., 3] *= scale_h
-        image = torch.nn.functional.interpolate(image.unsqueeze(0), size=(self.width, self.height), mode="bilinear")
-        return image.squeeze(0), label
+        image = v2.functional.resize(image, [self.height, self.width], antialias=True)
+        return image, label
 
-class ToTensor:
+class PILToTensor:
     def __call__(self, image: Image.Image, label: torch.Tensor|None = None):
-        return torchvision.transforms.functional.to_tensor(image), label # type: ignore
+        return v2.functional.pil_to_tensor(image), label
 
-class ColorJitter(torchvision.transforms.ColorJitter):
-    def __init__(self, brightness, contrast, saturation, hue):
-        super().__init__(brightness, contrast, saturation, hue)
+class ToDtype:
+    def __init__(self, dtype:torch.dtype=torch.float32):
+        self.dtype = dtype
 
     def __call__(self, image: torch.Tensor, label: torch.Tensor|None = None):
-        return super().__call__(image), label
-
-class RandomHorizontalFlip(torchvision.transforms.RandomHorizontalFlip):
-    def __init__(self, img_size:int, p:float=0.5):
-        super().__init__(p)
-        self.p = p
-        self.img_size = img_size
+        return v2.functional.to_dtype(image, self.dtype, scale=True), label
 
-    def __call__(self, image: torch.Tensor, label: torch.Tensor|None = None):
-        flipped_image = image
-        if torch.rand(1) < self.p:
-            flipped_image = torchvision.transforms.functional.hflip(image) # type: ignore
-            if label != None:
-                bbox_w = label[..., 2] - label[..., 0]
-                label[..., 0] = self.img_size - label[..., 2]
-                label[..., 2] = label[..., 0] + bbox_w
-        return flipped_image, label
-
-class RandomVerticalFlip(torchvision.transforms.RandomVerticalFlip):
-    def __init__(self, img_size:int, p:float=0.5):
-        super().__init__(p)
-        self.p = p
-        self.img_size = img_size
+class BatchAugmentation(torch.nn.Module):
+    """
+    colour jitter and random flips for a collated batch, run on the device the batch lives on.
 
-    def __call__(self, image: torch.Tensor, label: torch.Tensor|None = None):
-        flipped_image = image
-        if torch.rand(1) < self.p:
-            flipped_image = torchvision.transforms.functional.vflip(image) # type: ignore
-            if label != None:
-                bbox_h = label[..., 3] - label[..., 1]
-                label[..., 1] = self.img_size - label[..., 3]
-                label[..., 3] = label[..., 1] + bbox_h
-        return flipped_image, label
+    images: (B, 3, H, W), labels: (B, max_num_boxes, num_attributes) in xyxy, num_labels: (B,)
+    flips are chosen per sample and map x -> W - x (y -> H - y). padding rows are kept at zero.
+    jitter runs on the squared image, so the letterbox padding is jittered along with the image.
+    """
+    def __init__(self, p_hflip:float=0.5, p_vflip:float=0.5):
+        super().__init__()
+        self.p_hflip = p_hflip
+        self.p_vflip = p_vflip
+        self.color_jitter = kornia.augmentation.ColorJitter(brightness=0.5, contrast=0.5, saturation=0.5, hue=0.5)
+
+    def forward(self, images: torch.Tensor, labels: torch.Tensor, num_labels: torch.Tensor):
+        batch_size, _, height, width = images.shape
+        images = self.color_jitter(images)
+        bboxes = labels[..., :4]
+
+        hflip = torch.rand(batch_size, device=images.device) < self.p_hflip
+        images[hflip] = images[hflip].flip(-1)
+        hflipped = torch.stack([width - bboxes[..., 2], bboxes[..., 1], width - bboxes[..., 0], bboxes[..., 3]], dim=-1)
+        bboxes = torch.where(hflip.view(-1, 1, 1), hflipped, bboxes)
+
+        vflip = torch.rand(batch_size, device=images.device) < self.p_vflip
+        images[vflip] = images[vflip].flip(-2)
+        vflipped = torch.stack([bboxes[..., 0], height - bboxes[..., 3], bboxes[..., 2], height - bboxes[..., 1]], dim=-1)
+        bboxes = torch.where(vflip.view(-1, 1, 1), vflipped, bboxes)
+
+        arange = torch.arange(labels.shape[1], device=labels.device).unsqueeze(0)
+        len_mask = (arange < num_labels.to(labels.device, non_blocking=True).unsqueeze(-1)).unsqueeze(-1)
+        return images, torch.cat([bboxes * len_mask, labels[..., 4:]], dim=-1)
 
 def prepare_for_training(img_size:int):
     return LabelCompose(
         [
-            ToTensor(),
-            ColorJitter(brightness=0.5, contrast=0.5, saturation=0.5, hue=0.5),
             ToSquare(),
+            PILToTensor(),
             Resize(img_size, img_size),
-            RandomHorizontalFlip(img_size, p=1),
-            RandomVerticalFlip(img_size, p=1),
+            ToDtype(torch.float32),
         ]
     )
 
 def prepare_for_inference(img_size:int):
     return LabelCompose(
         [
-            ToTensor(),
             ToSquare(),
+            PILToTensor(),
             Resize(img_size, img_size),
+            ToDtype(torch.float32),
         ]
     )
 
+@numba.njit(cache=True)
+def _build_label(annotations:np.ndarray, num_attributes:int, max_num_boxes:int):
+    """
+    annotations: (N, 5) rows of (class index, x, y, w, h) for one image.
+    returns: (max_num_boxes, num_attributes) xyxy + confidence + one-hot label, number of boxes written.
+    """
+    output = np.zeros((max_num_boxes, num_attributes), dtype=np.float32)
+    num_boxes = min(annotations.shape[0], max_num_boxes)
+    for i in range(num_boxes):
+        x, y, w, h = annotations[i, 1], annotations[i, 2], annotations[i, 3], annotations[i, 4]
+        output[i, 0] = x
+        output[i, 1] = y
+        output[i, 2] = x + w
+        output[i, 3] = y + h
+        output[i, 4] = 1.0
+        output[i, 5 + int(annotations[i, 0])] = 1.0
+    return output, num_boxes
+
 class CocoBoundingBoxDataset(CocoDetection):
-    def __init__(self, images:str, annotations:str, category_ids:dict, img_size:int, num_classes:int, max_num_boxes:int, transform=prepare_for_inference):
+    def __init__(self, images:str, annotations:str, category_ids_lut:np.ndarray, img_size:int, num_classes:int, max_num_boxes:int, transform=prepare_for_inference):
+        """
+        category_ids_lut: coco category id - 1 -> class index, -1 for categories not in the dataset.
+        """
         super().__init__(images, annotations)
         self.transform = transform(img_size)
         self.num_classes = num_classes
         self.num_attributes = num_classes + 5
-        self.category_ids = category_ids
+        self.category_ids_lut = category_ids_lut
         self.max_num_boxes = max_num_boxes
 
+        # rows of (class index, x, y, w, h), image at dataset index i owns rows offsets[i]:offsets[i + 1]
+        targets = [self.coco.loadAnns(self.coco.getAnnIds(image_id)) for image_id in self.ids]
+        image_indices = np.repeat(np.arange(len(targets)), [len(t) for t in targets])
+        coco_category_ids = np.array([t['category_id'] for ts in targets for t in ts], dtype=np.int64)
+        bboxes = np.array([t['bbox'] for ts in targets for t in ts], dtype=np.float32).reshape(-1, 4)
+
+        # ids outside the table are treated like categories missing from the dataset
+        lut_indices = coco_category_ids - 1
+        in_range = (lut_indices >= 0) & (lut_indices < len(self.category_ids_lut))
+        class_indices = np.full(len(lut_indices), -1, dtype=np.int64)
+        class_indices[in_range] = self.category_ids_lut[lut_indices[in_range]]
+        valid = class_indices >= 0
+        self.annotations = np.concatenate((class_indices[valid, None].astype(np.float32), bboxes[valid]), axis=1)
+        counts = np.bincount(image_indices[valid], minlength=len(targets))
+        self.annotation_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
     def __getitem__(self, index:int): # type: ignore
-        image, targets = super().__getitem__(index)
-        outputs = []
-        for target in targets:
-            if (target['category_id'] - 1) not in self.category_ids:
-                continue
-
-            bbox = torch.tensor(target['bbox'], dtype=torch.float32, requires_grad=False)
-            fixed_bbox = xywh_to_xyxy(bbox)
-            confidence = torch.tensor([1.0], dtype=torch.float32, requires_grad=False)
-            index = self.category_ids[target['category_id'] - 1]
-            label = torch.eye(self.num_classes)[index]
-            output = torch.cat((fixed_bbox, confidence, label), dim=0)
-            outputs.append(output)
-
-        if len(outputs) > 0:
-            output_tensor = torch.stack(outputs)
-            num_box_padding = self.max_num_boxes - output_tensor.shape[0]
-
-            image_tensor, output_tensor = self.transform(image, output_tensor) # type: ignore
-            padded_output = torch.cat((output_tensor, torch.zeros(num_box_padding, output_tensor.shape[1])), dim=0) # type: ignore
-            return image_tensor, padded_output, output_tensor.shape[0] # type: ignore
+        # loaded directly instead of through super().__getitem__, which would also parse the annotation dicts
+        path = self.coco.loadImgs(self.ids[index])[0]['file_name']
+        image = Image.open(os.path.join(self.root, path)).convert("RGB")
+        start, end = self.annotation_offsets[index], self.annotation_offsets[index + 1]
+        label, num_boxes = _build_label(self.annotations[start:end], self.num_attributes, self.max_num_boxes)
+        padded_output = torch.from_numpy(label)
+        if num_boxes > 0:
+            image_tensor, output_tensor = self.transform(image, padded_output[:num_boxes]) # type: ignore
+            padded_output[:num_boxes] = output_tensor
+            return image_tensor, padded_output, num_boxes
         else:
             image_tensor, _ = self.transform(image, None) # type: ignore
-            padded_output = torch.zeros(self.max_num_boxes, self.num_attributes)
             return image_tensor, padded_output, 0
 
+def collate_coco_sample(sample):
+    images, labels, sizes = zip(*sample)
+    return torch.stack(images), torch.stack(labels), torch.tensor(sizes)
 
-def build_coco_dataloader(images_dir:str, annotations_dir:str, img_size:int, num_classes:int, max_num_boxes:int, batch_size:int, replacement:bool, transform):
+def build_coco_dataloader(images_dir:str, annotations_dir:str, img_size:int, num_classes:int, max_num_boxes:int, batch_size:int, replacement:bool, transform, num_workers:int|None=None):
     names_from_paper = "./data/coco-paper.names"
     actual_names = "./data/coco.names"
     keys, _ = get_names(names_from_paper, actual_names)
+    category_ids_lut = -np.ones(max(keys) + 1, dtype=np.int64)
+    for paper_index, index in keys.items():
+        category_ids_lut[paper_index] = index
     dataset = CocoBoundingBoxDataset(
         images=images_dir,
         annotations=annotations_dir,
-        category_ids=keys,
+        category_ids_lut=category_ids_lut,
         img_size=img_size,
         num_classes=num_classes,
         max_num_boxes=max_num_boxes,
         transform=transform
     )
 
-    def collate_coco_sample(sample):
-        images, labels, sizes = [], [], []
-        for image, label, size in sample:
-            images.append(image)
-            labels.append(label)
-            sizes.append(size)
-        return torch.stack(images), torch.stack(labels), torch.tensor(sizes)
-
     # dataloading
+    if num_workers is None:
+        # respects cpu affinity / cgroup limits, unlike os.cpu_count()
+        num_workers = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 0
     sampler = torch.utils.data.RandomSampler(dataset, replacement=replacement)
     dataloader = torch.utils.data.DataLoader(dataset,
                             batch_size=batch_size,
                             sampler=sampler,
-                            collate_fn=collate_coco_sample)
+                            collate_fn=collate_coco_sample,
+                            num_workers=num_workers,
+                            pin_memory=torch.cuda.is_available(),
+                            persistent_workers=num_workers > 0,
+                            prefetch_factor=4 if num_workers > 0 else None)
     return dataloader
 
-
-
+class CUDAPrefetcher:
+    """
+    wraps a dataloader, copying the next batch to the gpu on a side stream while the current batch is in use.
+    the dataloader should use pin_memory=True so the copies are asynchronous.
+    keep_on_host: positions in the batch left on the cpu, e.g. (2,) keeps the label counts readable without a sync.
+    """
+    def __init__(self, dataloader:torch.utils.data.DataLoader, device:torch.device|str="cuda", keep_on_host:tuple[int, ...]=()):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.keep_on_host = keep_on_host
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        self.stream = torch.cuda.Stream(device=self.device)
+        self.iterator = iter(self.dataloader)
+        self._prefetch()
+        return self
+
+    def _prefetch(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = tuple(tensor if i in self.keep_on_host else tensor.to(self.device, non_blocking=True)
+                                    for i, tensor in enumerate(batch))
+
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        batch = self.next_batch
+        for tensor in batch:
+            if tensor.is_cuda:
+                tensor.record_stream(current_stream)
+        self._prefetch()
+        return batch
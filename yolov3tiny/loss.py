@@ -1,7 +1,29 @@
+import warnings
 import torch
-from torchvision.ops.boxes import generalized_box_iou
 
-batched_giou = torch.vmap(generalized_box_iou)
+def batched_giou(boxes1: torch.Tensor, boxes2: torch.Tensor) -> torch.Tensor:
+    """
+    boxes1: (B, N, 4), boxes2: (B, M, 4), both xyxy.
+    returns: (B, N, M) generalized iou between every pair.
+    """
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
+    boxes1 = boxes1.unsqueeze(2)
+    boxes2 = boxes2.unsqueeze(1)
+
+    lt = torch.maximum(boxes1[..., :2], boxes2[..., :2])
+    rb = torch.minimum(boxes1[..., 2:], boxes2[..., 2:])
+    wh = (rb - lt).clamp(min=0)
+    inter = wh[..., 0] * wh[..., 1]
+    union = area1.unsqueeze(2) + area2.unsqueeze(1) - inter
+    iou = inter / union
+
+    lt = torch.minimum(boxes1[..., :2], boxes2[..., :2])
+    rb = torch.maximum(boxes1[..., 2:], boxes2[..., 2:])
+    wh = (rb - lt).clamp(min=0)
+    enclosing = wh[..., 0] * wh[..., 1]
+    return iou - (enclosing - union) / enclosing
+
 bce_with_logits = torch.nn.functional.binary_cross_entropy_with_logits
 
 class YOLOLoss(torch.nn.Module):
@@ -10,42 +32,59 @@ class YOLOLoss(torch.nn.Module):
                  object_weight:float=2,
                  no_object_weight:float=0.5,
                  class_weight:float=1,
-                 max_num_boxes:int=100):
+                 max_num_boxes:int|None=None,
+                 compile_giou:bool=False):
+        """
+        compile_giou: fuse batched_giou with torch.compile. worth it for long cuda runs,
+        compile time dominates short or cpu runs, so eager is the default.
+        """
         super().__init__()
         self.coord_weight = coord_weight
         self.object_weight = object_weight
         self.no_object_weight = no_object_weight
         self.class_weight = class_weight
-        self.max_num_boxes = max_num_boxes
+        # the length mask is sized from the targets passed to forward, kept so positional callers don't break
+        if max_num_boxes is not None:
+            warnings.warn("YOLOLoss max_num_boxes is unused and deprecated", DeprecationWarning, stacklevel=2)
+        self.giou = torch.compile(batched_giou, dynamic=True) if compile_giou else batched_giou
 
     def forward(self, predictions: torch.Tensor, targets: torch.Tensor, num_targets: torch.Tensor):
         batch_size, num_predictions, num_attributes = predictions.shape
-        arange = torch.arange(self.max_num_boxes).unsqueeze(0)
-        len_mask = (arange < num_targets.unsqueeze(-1))
+        device = predictions.device
+        # padding rows past the longest target list in the batch never match anything.
+        # only trimmed when the counts are on the host, reading them from the gpu would sync on the forward pass
+        if num_targets.device.type == "cpu":
+            targets = targets[:, :int(num_targets.max())]
+        arange = torch.arange(targets.shape[1], device=device).unsqueeze(0)
+        len_mask = (arange < num_targets.to(device, non_blocking=True).unsqueeze(-1))
 
         # coord loss
-        gious = batched_giou(predictions[..., :4], targets[..., :4])
+        gious = self.giou(predictions[..., :4], targets[..., :4])
         max_gious, max_giou_indices = torch.max(gious, dim=1)
         coord_loss = ((1 - max_gious) * len_mask)
         reduced_coord_loss = coord_loss.sum(dim=1).mean() * self.coord_weight
 
         # object loss
-        offset = (torch.arange(batch_size) * num_predictions).reshape(batch_size, 1)
-        max_giou_indices_offset = max_giou_indices + offset
+        offset = torch.arange(batch_size, device=device).unsqueeze(1) * num_predictions
+        max_giou_indices_offset = (max_giou_indices + offset)[len_mask]
 
-        obj_mask = torch.zeros(batch_size * num_predictions).scatter_(0, max_giou_indices_offset[len_mask], 1).reshape(batch_size, num_predictions)
-        object_loss = bce_with_logits(predictions[..., 4], torch.ones(predictions.shape[:-1]), reduction="none") * obj_mask
-        reduced_object_loss = object_loss.sum(dim=1).mean() * self.object_weight
+        obj_mask = torch.zeros(batch_size * num_predictions, dtype=torch.bool, device=device)
+        obj_mask[max_giou_indices_offset] = True
+        obj_mask = obj_mask.view(batch_size, num_predictions)
+        # selecting with where keeps the loss dtype-agnostic (fp16 safe) and zeroes masked gradients
+        confidence_logits = predictions[..., 4]
+        object_loss = bce_with_logits(confidence_logits, torch.ones_like(confidence_logits), reduction="none")
+        object_loss = torch.where(obj_mask, object_loss, 0).sum()
+        reduced_object_loss = object_loss / batch_size * self.object_weight
 
         # no object loss
         # might need an ignore mask
-        no_obj_mask = torch.logical_not(obj_mask)
-        no_object_loss = bce_with_logits(predictions[..., 4], torch.zeros(predictions.shape[:-1]), reduction="none") * no_obj_mask
-        reduced_no_object_loss = no_object_loss.sum(dim=1).mean() * self.no_object_weight
+        no_object_loss = bce_with_logits(confidence_logits, torch.zeros_like(confidence_logits), reduction="none")
+        no_object_loss = torch.where(obj_mask, 0, no_object_loss).sum()
+        reduced_no_object_loss = no_object_loss / batch_size * self.no_object_weight
 
         # class loss
-        all_class_probs = predictions[..., 5:].reshape(-1, num_attributes - 5)
-        class_probs = all_class_probs[max_giou_indices_offset[len_mask], :]
+        class_probs = predictions.reshape(-1, num_attributes)[max_giou_indices_offset, 5:]
         target_class_probs = targets[..., 5:][len_mask]
         class_loss = bce_with_logits(class_probs, target_class_probs, reduction="none")
         reduced_class_loss = class_loss.sum(dim=1).mean() * self.class_weight
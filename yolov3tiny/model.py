@@ -1,8 +1,6 @@
 import torch
 from typing import List, Tuple
 
-from yolov3tiny.data import cxcywh_to_xyxy
-
 class Convolution(torch.nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, negative_slope=0.1):
         assert kernel_size == 1 or kernel_size == 3
@@ -18,44 +16,39 @@ class Convolution(torch.nn.Module):
         return self.leaky_relu(output)
 
 class YOLOLayer(torch.nn.Module):
-    def __init__(self, num_attributes:int, anchors:List[Tuple[int, int]], img_size:int):
+    def __init__(self, num_attributes:int, anchors:List[Tuple[int, int]], img_size:int, stride:int):
         super().__init__()
         self.num_attributes = num_attributes
         assert len(anchors) == 3
-        self.anchors = torch.tensor(anchors)
+        self.register_buffer("anchors", torch.tensor(anchors, dtype=torch.float32), persistent=False)
         self.img_size = img_size
 
+        assert img_size % stride == 0
+        self.stride = stride
+        self.grid_size = img_size // stride
+        offset = torch.arange(self.grid_size).repeat(3, self.grid_size, 1) # (3, grid_size, grid_size)
+        grid = torch.stack([offset, offset.transpose(-1, -2)], dim=-1) # (3, grid_size, grid_size, 2)
+        self.register_buffer("grid", grid.float(), persistent=False)
+
     def forward(self, input):
         batch_size, channels, width, height = input.shape
-        assert width == height
-        grid_size = width
-
-        assert self.img_size % grid_size == 0
-        stride = self.img_size // grid_size
+        assert width == height == self.grid_size
+        grid_size = self.grid_size
+        stride = self.stride
 
         assert channels == self.num_attributes * 3
 
         input = input.reshape(batch_size, 3, self.num_attributes, grid_size, grid_size) # (n,c,w,h) -> (n, 3, c/3, w, h)
         input = input.permute(0, 1, 3, 4, 2) # (n, 3, w, h, c/3), c/3 == self.num_attributes
 
-        offset = torch.arange(grid_size).repeat(3, grid_size, 1) # (3, grid_size, grid_size)
-        x_offset = offset.unsqueeze(0) # (1, 3, grid_size, grid_size)
-        y_offset = offset.transpose(-1, -2).unsqueeze(0)
-
-        anchor_w = self.anchors[..., 0].reshape(3, 1, 1)
-        anchor_h = self.anchors[..., 1].reshape(3, 1, 1)
-
         # format: cx, cy, w, h
-        x_pred = (torch.sigmoid(input[..., 0]) + x_offset) * stride
-        y_pred = (torch.sigmoid(input[..., 1]) + y_offset) * stride
-
-        w_pred = anchor_w * torch.exp(input[..., 2])
-        h_pred = anchor_h * torch.exp(input[..., 3])
-
-        bbox = torch.stack([x_pred, y_pred, w_pred, h_pred], dim=4)
-        bbox = cxcywh_to_xyxy(bbox)
+        xy_pred = (torch.sigmoid(input[..., 0:2]) + self.grid) * stride
+        wh_pred = torch.exp(input[..., 2:4]) * self.anchors.view(3, 1, 1, 2)
 
-        return torch.cat([bbox, input[..., 4:]], dim=4).reshape(batch_size, -1, self.num_attributes)
+        # xyxy corners are written straight into the output, no intermediate bbox tensor
+        half_wh_pred = wh_pred / 2
+        output = torch.cat([xy_pred - half_wh_pred, xy_pred + half_wh_pred, input[..., 4:]], dim=4)
+        return output.reshape(batch_size, -1, self.num_attributes)
 
 class YOLOv3tiny(torch.nn.Module):
     def __init__(self, num_classes:int, anchors:List[Tuple[int, int]], img_size:int):
@@ -81,8 +74,8 @@ class YOLOv3tiny(torch.nn.Module):
         self.conv_layer_21 = Convolution(384, 256, 3)
         self.conv_layer_22 = Convolution(256, 3 * self.num_attributes, 1)
 
-        self.yolo_layer = YOLOLayer(self.num_attributes, anchors[3:], img_size)
-        self.yolo_layer_upsampled = YOLOLayer(self.num_attributes, anchors[:3], img_size)
+        self.yolo_layer = YOLOLayer(self.num_attributes, anchors[3:], img_size, 32)
+        self.yolo_layer_upsampled = YOLOLayer(self.num_attributes, anchors[:3], img_size, 16)
 
 
     def forward(self, input):